@@ -1,10 +1,18 @@
 # --- Image Opening (Marketplace-based header preservation + PDF skip + dynamic filename) ---
+import gc
 import io
+import queue
 import re
+import threading
 import traceback
+import pandas as pd
 import requests
+import requests_cache
 import streamlit as st
-from typing import List, Set, Optional
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import List, Set, Optional, Tuple
+from PIL import Image
 from openpyxl import load_workbook
 from openpyxl.comments import Comment
 from openpyxl.utils import get_column_letter
@@ -15,21 +23,23 @@ st.set_page_config(page_title="Image Opening", layout="wide")
 # ---------------- URL helpers ----------------
 HTTP_URL_RE = re.compile(r'^(https?://)?([A-Za-z0-9\.\-]+\.[A-Za-z]{2,})(/.*)$', re.IGNORECASE)
 LIKELY_CDN_RE = re.compile(r'^(cdn\.|media\.|images\.|static\.)', re.IGNORECASE)
+# One anchored alternation classifying URL-like cells: explicit scheme, known
+# CDN prefix, or bare host.tld/path. Matched column-wise by _url_mask.
+URL_PATTERN = r'^(?:https?://|(?:cdn|media|images|static)\.|[A-Za-z0-9.\-]+\.[A-Za-z]{2,}/)'
 DEFAULT_SCHEME = "https://"
 
-def is_url_like(s: str) -> bool:
-    if not isinstance(s, str): return False
-    s = s.strip()
-    if not s: return False
-    if s.lower().startswith(("http://", "https://")): return True
-    if HTTP_URL_RE.match(s): return True
-    if LIKELY_CDN_RE.match(s): return True
-    return False
+try:  # pyarrow-backed strings: the scan regexes run on contiguous UTF-8 buffers
+    pd.options.future.infer_string = True
+except Exception:
+    pass
 
+# Product feeds repeat the same URLs across rows; memoize normalization
+@lru_cache(maxsize=200_000)
 def normalize_url(s: str, default_scheme: str = DEFAULT_SCHEME) -> Optional[str]:
     if not s: return None
     s = s.strip().strip('"').strip("'")
-    if s.lower().startswith(("http://", "https://")): return s
+    # lowercase only the scheme prefix, not the whole URL
+    if s[:8].lower().startswith(("http://", "https://")): return s
     m = HTTP_URL_RE.match(s)
     if m:
         scheme, host, path = m.group(1), m.group(2), m.group(3)
@@ -42,69 +52,159 @@ def normalize_url(s: str, default_scheme: str = DEFAULT_SCHEME) -> Optional[str]
         return f"{default_scheme}{s}"
     return None
 
-# HEAD/GET content-type detection (for skipping PDFs and non-images)
-def get_content_type(url: str, timeout: float = 10.0) -> Optional[str]:
-    try:
-        r = requests.head(url, timeout=timeout, allow_redirects=True)
-        ct = r.headers.get("Content-Type")
-        if ct: return ct.lower()
-    except Exception:
-        pass
-    try:
-        r = requests.get(url, timeout=timeout, stream=True, allow_redirects=True)
-        ct = r.headers.get("Content-Type")
-        if ct: return ct.lower()
-    except Exception:
-        pass
-    return None
-
-def is_image_content_type(ct: Optional[str]) -> bool:
-    return bool(ct and ct.startswith("image/"))
+# One session shared across download workers (HTTP keep-alive / connection reuse).
+# requests' pool_maxsize is per host, and a typical catalog serves every image
+# from one CDN host, so it must cover the full worker fan-out or workers just
+# block waiting for a pooled connection.
+# The sqlite backend persists bodies + ETag/Last-Modified across app runs, so
+# re-processing the same catalog revalidates via If-None-Match (304, no body)
+# instead of redownloading every image.
+MAX_DOWNLOAD_WORKERS = 24
+DOWNLOAD_QUEUE_DEPTH = 64  # max downloaded bodies in flight before workers block
+
+# JPEG / PNG / GIF / BMP signatures; WEBP needs the RIFF container check below
+_IMAGE_MAGIC = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"GIF8", b"BM")
+
+def _is_image_magic(head: bytes) -> bool:
+    if head.startswith(_IMAGE_MAGIC): return True
+    return len(head) >= 12 and head[:4] == b"RIFF" and head[8:12] == b"WEBP"
+
+@st.cache_resource(show_spinner=False)
+def get_session() -> requests_cache.CachedSession:
+    adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=MAX_DOWNLOAD_WORKERS,
+                                            pool_block=True)
+    session = requests_cache.CachedSession(
+        ".img_cache", backend="sqlite", expire_after=86400,
+        allowable_methods=("GET",), cache_control=True,
+        # don't let PDFs and other non-image bodies bloat the disk cache
+        filter_fn=lambda r: _is_image_magic(r.content[:16]),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"User-Agent": "excel-image-inplace/1.0"})
+    return session
+
+SESSION = get_session()
+
+# Single GET per URL: sniff the magic bytes of the first chunk and reject
+# non-images (PDFs etc.). Sniffing beats trusting Content-Type — CDNs
+# routinely send application/octet-stream for images and image/* for error
+# pages. Note the caching session reads the whole body regardless of
+# stream=True, so this classifies rather than saves bandwidth; its filter_fn
+# uses the same sniff to keep rejected bodies out of the disk cache.
+def fetch_image_bytes(url: str, timeout: float = 25.0) -> Tuple[Optional[bytes], Optional[str]]:
+    with SESSION.get(url, timeout=timeout, stream=True, allow_redirects=True) as r:
+        r.raise_for_status()
+        ct = (r.headers.get("Content-Type") or "").lower() or None
+        it = r.iter_content(chunk_size=65536)
+        head = next(it, b"")
+        if not _is_image_magic(head):
+            return None, ct or "unknown signature"
+        return head + b"".join(it), ct
 
 # ---------------- Excel helpers ----------------
 def px_to_col_width(px:int)->float: return round(px/7.0, 2)
 def px_to_row_height(px:int)->float: return round(px*0.75, 2)
 
-def detect_url_columns(ws, header_row:int=1)->List[int]:
-    hits = []
-    for c in range(1, ws.max_column + 1):
-        for r in range(header_row + 1, min(ws.max_row, header_row + 50) + 1):
-            v = ws.cell(row=r, column=c).value
-            if isinstance(v, str) and is_url_like(v):
-                hits.append(c); break
-    return hits
-
-def columns_by_names(ws, names:List[str], header_row:int=1)->List[int]:
-    name_map = {}
-    for c in range(1, ws.max_column + 1):
-        v = ws.cell(row=header_row, column=c).value
-        if isinstance(v, str): name_map[v.strip()] = c
-    return [name_map[n] for n in names if n in name_map]
-
-def iter_target_cells(ws, target_cols:Set[int], header_row:int):
-    for r in range(header_row + 1, ws.max_row + 1):
-        for c in target_cols:
-            yield ws.cell(row=r, column=c)
-
-def adjust_dimensions(ws, col_indices:Set[int], row_height_px:int, preserve_top_rows:int):
+# Column-wise URL matching goes through pandas' C string kernels rather than a
+# Python-level loop over every cell value.
+def _url_mask(col: pd.Series) -> pd.Series:
+    return col.dropna().astype(str).str.strip().str.match(URL_PATTERN, flags=re.IGNORECASE)
+
+def scan_sheet(ws, header_row:int=1):
+    """One traversal of the sheet: header labels, URL-bearing columns, and the
+    per-column [(row, value)] URL candidates everything downstream consumes."""
+    rows = list(ws.iter_rows(min_row=header_row, values_only=True))
+    header = rows[0] if rows else ()
+    headers = [v.strip() if isinstance(v, str) else f"Col {c}" for c, v in enumerate(header, 1)]
+    candidates = {}
+    if len(rows) > 1:
+        df = pd.DataFrame(rows[1:])
+        for i in df.columns:
+            mask = _url_mask(df[i])
+            hits = mask[mask].index
+            if len(hits):
+                candidates[i + 1] = [(header_row + 1 + int(j), df.iat[int(j), int(i)]) for j in hits]
+    return headers, sorted(candidates), candidates
+
+# Streamlit reruns the whole script on every widget change; cache the parse
+# and scan on the uploaded bytes so only the first upload pays for them.
+@st.cache_data(show_spinner=False)
+def workbook_sheetnames(data: bytes) -> List[str]:
+    wb = load_workbook(io.BytesIO(data), read_only=True)
+    try:
+        return wb.sheetnames
+    finally:
+        wb.close()
+
+@st.cache_data(show_spinner=False)
+def scan_workbook(data: bytes, header_row: int) -> dict:
+    wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        return {s: scan_sheet(wb[s], header_row) for s in wb.sheetnames}
+    finally:
+        wb.close()
+
+# 1-based lookup table so hot loops index a list instead of re-deriving the
+# base-26 letters per cell
+def column_letter_table(max_col:int)->List[Optional[str]]:
+    return [None] + [get_column_letter(i) for i in range(1, max_col + 1)]
+
+def adjust_dimensions(ws, col_indices:Set[int], row_height_px:int, preserve_top_rows:int,
+                      col_letters:Optional[List[Optional[str]]]=None):
     for c in col_indices:
-        ws.column_dimensions[get_column_letter(c)].width = px_to_col_width(row_height_px)
+        letter = col_letters[c] if col_letters else get_column_letter(c)
+        ws.column_dimensions[letter].width = px_to_col_width(row_height_px)
     target_h_pt = px_to_row_height(row_height_px)
-    for r in range(1, ws.max_row + 1):
-        if r <= max(0, preserve_top_rows):
-            continue
-        ws.row_dimensions[r].height = target_h_pt
-
-def place_anchor_image(ws, cell, url: str, w_px: int, h_px: int, keep_note: bool):
-    resp = requests.get(url, timeout=25)
-    resp.raise_for_status()
-    data = io.BytesIO(resp.content)
+    # One sheet-level default height instead of a RowDimension (and a <row ht>
+    # record on save) per row; only preserved top rows get explicit overrides,
+    # pinned to their current height so the new default doesn't touch them.
+    prior_default = ws.sheet_format.defaultRowHeight or 15.0
+    for r in range(1, max(0, preserve_top_rows) + 1):
+        if ws.row_dimensions[r].height is None:
+            ws.row_dimensions[r].height = prior_default
+    ws.sheet_format.defaultRowHeight = target_h_pt
+    ws.sheet_format.customHeight = True
+
+# Sources already smaller than this are embedded as-is
+SHRINK_THRESHOLD_BYTES = 30 * 1024
+
+def shrink_image_bytes(content: bytes, w_px: int, h_px: int) -> bytes:
+    # A multi-MB source PNG would be embedded verbatim for a ~140px cell;
+    # downscale to 2x the display size and re-encode as JPEG-85 instead.
+    if len(content) <= SHRINK_THRESHOLD_BYTES:
+        return content
+    try:
+        im = Image.open(io.BytesIO(content))
+        im.thumbnail((w_px * 2, h_px * 2), Image.LANCZOS)
+        buf = io.BytesIO()
+        im.convert("RGB").save(buf, "JPEG", quality=85, optimize=True)
+        return buf.getvalue()
+    except Exception:
+        return content  # not decodable by Pillow; let openpyxl try the original
+
+# Runs on a worker thread: no openpyxl access (workbook state is not thread-safe)
+def fetch_image(url: str, w_px: int, h_px: int) -> Tuple[str, object]:
+    content, ct = fetch_image_bytes(url)
+    if content is None:
+        return ("skip", ct)
+    return ("ok", shrink_image_bytes(content, w_px, h_px))
+
+def place_anchor_image(ws, row: int, col: int, url: str, content: bytes, w_px: int, h_px: int,
+                       keep_note: bool, buffers: Optional[list] = None,
+                       col_letters: Optional[List[Optional[str]]] = None):
+    # Fresh BytesIO per image: openpyxl closes the ref buffer after reading it
+    # at save time, so repeat URLs must not share one stream (the bytes
+    # themselves are still shared via the fetch cache)
+    data = io.BytesIO(content)
+    if buffers is not None:
+        buffers.append(data)
     img = XLImage(data)
     img.width = w_px
     img.height = h_px
-    img.anchor = cell.coordinate
+    img.anchor = f"{col_letters[col] if col_letters else get_column_letter(col)}{row}"
     ws.add_image(img)
-    if keep_note: cell.comment = Comment(f"Original URL:\\n{url}", "PreviewBot")
+    if keep_note: ws.cell(row=row, column=col).comment = Comment(f"Original URL:\\n{url}", "PreviewBot")
 
 # ---------------- UI ----------------
 st.title("Image Opening")
@@ -113,8 +213,7 @@ uploaded = st.file_uploader("Upload your Excel masterfile (.xlsx)", type=["xlsx"
 try:
     if uploaded:
         data = uploaded.read()
-        wb = load_workbook(io.BytesIO(data))
-        sheets = wb.sheetnames
+        sheets = workbook_sheetnames(data)
 
         st.sidebar.header("Settings")
 
@@ -147,13 +246,12 @@ try:
         create_adjacent = st.sidebar.checkbox("Create preview in NEW adjacent column(s)", value=False,
                                               help="Keep URL column intact; add *_preview column to the right.")
 
-        # Detect URL columns
-        ws0 = wb[target_sheets[0]]
-        headers = []
-        for c in range(1, ws0.max_column + 1):
-            v = ws0.cell(row=header_row, column=c).value
-            headers.append(v.strip() if isinstance(v, str) else f"Col {c}")
-        auto_cols_idx = detect_url_columns(ws0, header_row=header_row)
+        # One pass per sheet: headers, URL-bearing columns, candidate cells.
+        # Cached on (file bytes, header row), so widget interactions after the
+        # first upload reuse the scan instead of reparsing the xlsx.
+        scans = scan_workbook(data, header_row)
+
+        headers, auto_cols_idx, _ = scans[target_sheets[0]]
         auto_cols_names = [headers[i-1] if i-1 < len(headers) else f"Col {i}" for i in auto_cols_idx]
 
         selected_by_name = st.multiselect(
@@ -162,20 +260,20 @@ try:
             default=auto_cols_names
         )
 
-        def headers_to_indices(ws, names:List[str])->Set[int]:
-            return set(columns_by_names(ws, names, header_row=header_row))
+        def headers_to_indices(sheet_headers:List[str], names:List[str])->Set[int]:
+            name_map = {h: i + 1 for i, h in enumerate(sheet_headers)}
+            return {name_map[n] for n in names if n in name_map}
+
+        def sheet_targets(s:str)->Set[int]:
+            sheet_headers, url_cols, _ = scans[s]
+            return headers_to_indices(sheet_headers, selected_by_name) if selected_by_name else set(url_cols)
 
-        # Preview summary
+        # Preview summary — counts come straight from the scan candidates
         total_urls = 0
         preview_rows = []
         for s in target_sheets:
-            ws = wb[s]
-            targets = headers_to_indices(ws, selected_by_name) if selected_by_name else set(detect_url_columns(ws, header_row=header_row))
-            count = 0
-            for cell in iter_target_cells(ws, targets, header_row=header_row):
-                v = cell.value if not create_adjacent else ws.cell(row=cell.row, column=cell.column - 1).value
-                if isinstance(v, str) and is_url_like(v):
-                    count += 1
+            targets = sheet_targets(s)
+            count = sum(len(scans[s][2].get(c, ())) for c in targets)
             total_urls += count
             preview_rows.append((s, len(targets), count))
 
@@ -188,74 +286,151 @@ try:
 
         # Process images
         if st.button("Process & Prepare Download", type="primary"):
+            # Mutation needs the full DOM; build it only now
+            wb = load_workbook(io.BytesIO(data))
             processed = inserted = skipped_nonimage = failed = 0
             progress = st.progress(0)
             status = st.empty()
 
+            # Masterfiles repeat URLs across rows (variant SKUs share a hero shot):
+            # download each distinct URL once per run and reuse the bytes.
+            fetch_cache = {}  # url -> ("ok", bytes) | ("skip", ct) | ("error", exc)
+            buffers = []      # every BytesIO handed to openpyxl, closed after save
+
             for s in target_sheets:
                 ws = wb[s]
-                targets = headers_to_indices(ws, selected_by_name) if selected_by_name else set(detect_url_columns(ws, header_row=header_row))
+                sheet_headers, _, candidates = scans[s]
+                targets = sheet_targets(s)
                 if not targets: continue
 
-                # Decide preview columns (same or adjacent)
-                preview_targets = set()
+                # Decide preview columns (same or adjacent); map each source
+                # URL column to the column its previews land in
+                preview_col_of = {}
                 if create_adjacent:
                     inserted_cols = 0
                     for col_idx in sorted(targets):
                         insert_at = col_idx + 1 + inserted_cols
                         ws.insert_cols(insert_at)
-                        base = ws.cell(row=header_row, column=col_idx + inserted_cols).value
-                        if isinstance(base, str): base = base.strip()
+                        base = sheet_headers[col_idx - 1] if col_idx - 1 < len(sheet_headers) else None
                         ws.cell(row=header_row, column=insert_at).value = f"{base or f'Col {col_idx}'}_preview"
-                        preview_targets.add(insert_at)
+                        preview_col_of[col_idx] = insert_at
                         inserted_cols += 1
                 else:
-                    preview_targets = targets
+                    preview_col_of = {c: c for c in targets}
+                preview_targets = set(preview_col_of.values())
 
-                # Resize grid (preserving top N rows)
-                adjust_dimensions(ws, preview_targets, row_height_px=max(width, height), preserve_top_rows=preserve_top_rows)
-
-                # Insert images
-                for cell in iter_target_cells(ws, preview_targets, header_row=header_row):
-                    src_cell = cell if not create_adjacent else ws.cell(row=cell.row, column=cell.column - 1)
-                    val = src_cell.value
-                    if not (isinstance(val, str) and is_url_like(val)):
-                        continue
-                    url = normalize_url(val) or val.strip()
-
-                    ct = get_content_type(url)
-                    if not is_image_content_type(ct):
-                        skipped_nonimage += 1
-                        if keep_notes and not create_adjacent:
-                            try:
-                                cell.comment = Comment(f"Skipped (non-image: {ct or 'unknown'})\n{url}", "PreviewBot")
-                            except Exception:
-                                pass
-                        processed += 1
-                        if total_urls:
-                            progress.progress(min(processed/total_urls, 1.0))
-                            status.write(f"Processed {processed}/{total_urls} | inserted:{inserted}, skipped:{skipped_nonimage}, failed:{failed}")
-                        continue
+                # Column letters for this sheet, computed once (after any
+                # column inserts so indices line up)
+                col_letters = column_letter_table(ws.max_column)
 
+                # Resize grid (preserving top N rows)
+                adjust_dimensions(ws, preview_targets, row_height_px=max(width, height),
+                                  preserve_top_rows=preserve_top_rows, col_letters=col_letters)
+
+                # Jobs come straight from the scan-phase candidates — no
+                # re-walk of the sheet here
+                jobs = [(r_idx, preview_col_of[c], normalize_url(val) or val.strip())
+                        for c in sorted(targets)
+                        for r_idx, val in candidates.get(c, ())]
+
+                # Pass 2: fan downloads out across threads, one fetch per
+                # distinct URL, pipelined through a bounded queue. Each worker
+                # enqueues its own result, so a full queue backpressures the
+                # pool itself: at most DOWNLOAD_QUEUE_DEPTH queued bodies plus
+                # one per worker exist at a time, and the main thread inserts
+                # as results arrive. All openpyxl mutation (add_image,
+                # comments) stays on the main thread.
+                cells_by_url = {}
+                for r_idx, c, url in jobs:
+                    cells_by_url.setdefault(url, []).append((r_idx, c))
+
+                pending = [u for u in cells_by_url if u not in fetch_cache]
+                results_q = queue.Queue(maxsize=DOWNLOAD_QUEUE_DEPTH)
+                stop = threading.Event()  # unblocks putting workers if insertion dies
+
+                def fetch_to_queue(u, q=results_q):
                     try:
-                        place_anchor_image(ws, cell, url, width, height, keep_note=keep_notes and not create_adjacent)
-                        inserted += 1
+                        item = (u, fetch_image(u, width, height))
                     except Exception as e:
-                        failed += 1
-                        if keep_notes and not create_adjacent:
-                            try:
-                                cell.comment = Comment(f"Preview failed; kept value.\n{url}\nError: {e}", "PreviewBot")
-                            except Exception:
-                                pass
-                    finally:
-                        processed += 1
-                        if total_urls:
-                            progress.progress(min(processed/total_urls, 1.0))
-                            status.write(f"Processed {processed}/{total_urls} | inserted:{inserted}, skipped:{skipped_nonimage}, failed:{failed}")
+                        item = (u, ("error", e))
+                    while not stop.is_set():
+                        try:
+                            q.put(item, timeout=1.0)
+                            return
+                        except queue.Full:
+                            pass
+
+                ex = ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS)
+                try:
+                    for u in pending:
+                        ex.submit(fetch_to_queue, u)
+
+                    def sheet_results(q=results_q):
+                        # URLs resolved on an earlier sheet first, then exactly
+                        # one queue item per freshly submitted URL
+                        for u in cells_by_url:
+                            if u in fetch_cache:
+                                yield u, fetch_cache[u]
+                        for _ in range(len(pending)):
+                            yield q.get()
+
+                    for url, (kind, payload) in sheet_results():
+                        fetch_cache[url] = (kind, payload)
+                        url_cells = cells_by_url[url]
+                        for r_idx, c in url_cells:
+                            if kind == "skip":
+                                skipped_nonimage += 1
+                                if keep_notes and not create_adjacent:
+                                    try:
+                                        ws.cell(row=r_idx, column=c).comment = Comment(f"Skipped (non-image: {payload or 'unknown'})\n{url}", "PreviewBot")
+                                    except Exception:
+                                        pass
+                            elif kind == "error":
+                                failed += 1
+                                if keep_notes and not create_adjacent:
+                                    try:
+                                        ws.cell(row=r_idx, column=c).comment = Comment(f"Preview failed; kept value.\n{url}\nError: {payload}", "PreviewBot")
+                                    except Exception:
+                                        pass
+                            else:
+                                try:
+                                    place_anchor_image(ws, r_idx, c, url, payload, width, height,
+                                                       keep_note=keep_notes and not create_adjacent,
+                                                       buffers=buffers, col_letters=col_letters)
+                                    inserted += 1
+                                except Exception as e:
+                                    failed += 1
+                                    if keep_notes and not create_adjacent:
+                                        try:
+                                            ws.cell(row=r_idx, column=c).comment = Comment(f"Preview failed; kept value.\n{url}\nError: {e}", "PreviewBot")
+                                        except Exception:
+                                            pass
+
+                            processed += 1
+                            if total_urls:
+                                progress.progress(min(processed/total_urls, 1.0))
+                                status.write(f"Processed {processed}/{total_urls} | inserted:{inserted}, skipped:{skipped_nonimage}, failed:{failed}")
+                finally:
+                    stop.set()
+                    ex.shutdown(wait=False, cancel_futures=True)
 
             # Save file + dynamic naming
             out = io.BytesIO()
             wb.save(out); out.seek(0)
+
+            # openpyxl holds every XLImage's BytesIO until save; Streamlit's
+            # server process is long-lived, so release them now instead of
+            # letting each run's image buffers accumulate.
+            for b in buffers:
+                try:
+                    b.close()
+                except Exception:
+                    pass
+            buffers.clear()
+            fetch_cache.clear()
+            del wb
+            gc.collect()
+
             orig_name = uploaded.name
             out_name = orig_name[:-5] + "-preview.xlsx" if orig_name.lower().endswith(".xlsx") else orig_name + "-preview.xlsx"
 